@@ -6,110 +6,138 @@ StackSet via CloudFormation
 # Allow for stack Retention
 
 import boto3
+import hashlib
+import itertools
+import logging
+import random
+import re
 from time import sleep
+from botocore.config import Config
 from botocore.exceptions import ClientError
 import os
 
 import crhelper
 
+# Region the function runs in, and where the StackSets are managed from
+_AWS_REGION = os.environ['AWS_REGION']
+
 # initialise logger
 logger = crhelper.log_config({"RequestId": "CONTAINER_INIT"})
 logger.info('Logging configured')
+
+# Let botocore absorb throttling and transient errors with its adaptive
+# (token bucket) retry mode.  OperationInProgressException is not retried by
+# the SDK, so _retry still handles that case.
+_BOTO_CFG = Config(retries={'max_attempts': 10, 'mode': 'adaptive'})
+
+# CloudFormation clients by region.  This lives at module scope so it
+# survives warm invocations of the container.
+_client_cache = {}
+
+# Most recent OperationId we started on each (StackSet name, region), so an
+# OperationInProgressException can wait on that operation rather than sleep.
+_last_operation = {}
+
+# StackSet operation statuses after which another operation can start.
+_TERMINAL_OPERATION_STATUSES = frozenset(('SUCCEEDED', 'FAILED', 'STOPPED'))
+
 # set global to track init failures
 init_failed = False
+# CloudFormation RequestId of the event being handled.  It is mixed into the
+# OperationIds we generate, see _operation_id.
+request_id = None
 
 try:
     # Place initialization code here
+    # Build this region's CloudFormation client now so session setup,
+    # credential lookup and endpoint resolution happen once per container
+    # rather than on the first event.  No API calls are made here.
+    _client_cache[_AWS_REGION] = boto3.session.Session().client(
+        'cloudformation', region_name=_AWS_REGION, config=_BOTO_CFG)
     logger.info("Container initialization completed")
 except Exception as e:
     logger.error(e, exc_info=True)
     init_failed = e
 
 
+# Captures the resource name from an ARN, skipping any resource type prefix
+# (e.g. arn:aws:cloudformation:us-east-1:123456789012:stack/MyStack/guid).
+_ARN_RE = re.compile(r'^arn:[^:]+:[^:]+:[^:]*:[^:]*:(?:[^:/]+[:/])?(?P<resource>[^:/]+)')
+
+
 def get_stack_from_arn(arn):
     # Given the ARN of a CloudFormation stack, return the stack name
-    (arn, partion, service, region, account, resourcepart) = arn.split(':', 5)
-    if ':' in resourcepart:
-        (resourcetype, resource) = resourcepart.split(':')
-    elif '/' in resourcepart:
-        resourceparts = resourcepart.split('/')
-        resource = resourceparts[1]
-    else:
-        (resource) = resourcepart
-    return(resource)
+    match = _ARN_RE.match(arn)
+    if match:
+        return(match.group('resource'))
+    return(arn.rsplit('/', 1)[-1].rsplit(':', 1)[-1])
+
+
+_MISSING = object()
+
+# Resource properties whose change requires updating the StackSet itself
+_STACK_SET_UPDATE_ATTRS = ('TemplateURL', 'Parameters', 'Tags', 'Capabilities',
+                           'StackSetDescription')
 
 
 def change_requires_update(attributes, old_values, current_values):
     # Given a list of attributes, compare the old and new values to see if
-    # there's been a change.
-    for attribute in attributes:
-        if (attribute not in old_values) and (attribute in current_values):
-            logger.debug("New value for %s: %s" % (attribute, current_values[attribute]))
-            return True
-        if (attribute in old_values) and (attribute not in current_values):
-            logger.debug("Value removed for %s: %s" % (attribute, old_values[attribute]))
-            return True
-        if (attribute in old_values) and (attribute in current_values):
-            logger.debug("Evaluating %s: %s vs. %s" % (attribute, current_values[attribute], old_values[attribute]))
-            if current_values[attribute] != old_values[attribute]:
-                return True
-    return False
+    # there's been a change.  An attribute that is only present on one side
+    # counts as a change.
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Changed attributes: %s",
+                     [attribute for attribute in attributes
+                      if old_values.get(attribute, _MISSING) != current_values.get(attribute, _MISSING)])
+    return any(old_values.get(attribute, _MISSING) != current_values.get(attribute, _MISSING)
+               for attribute in attributes)
+
+
+# Operation Preferences keys that need converting to ints, and keys that are
+# passed through as-is.  Anything else is skipped.
+_OPS_NUMERIC = frozenset(('FailureToleranceCount', 'FailureTolerancePercentage',
+                          'MaxConcurrentCount', 'MaxConcurrentPercentage'))
+_OPS_PASSTHROUGH = frozenset(('RegionOrder',))
 
 
 def convert_ops_prefs(ops_prefs):
     # CloudFormation parameters are all strings.  We need to convert numeric
     # values in the ops_prefs JSON object to ints before we can call the API
     logger.info("Converting Operation Preferences values")
-    converted_ops_prefs = {}
-    needs_conversion = set(['FailureToleranceCount', 'FailureTolerancePercentage', 'MaxConcurrentCount', 'MaxConcurrentPercentage'])
-    for key, value in ops_prefs.items():
-        logger.debug("Evaluating %s : %s" % (key, value))
-        if key in needs_conversion:
-            logger.debug("Converting %s" % key)
-            converted_ops_prefs[key] = int(value)
-        elif key == 'RegionOrder':
-            converted_ops_prefs['RegionOrder'] = value
-        else:
-            logger.warning("Warning: Skipping unknown key: %s in Operation Preferences" % key)
-    return(converted_ops_prefs)
+    skipped = ops_prefs.keys() - _OPS_NUMERIC - _OPS_PASSTHROUGH
+    if skipped:
+        logger.warning("Warning: Skipping unknown keys: %s in Operation Preferences", ', '.join(sorted(skipped)))
+    return({key: (int(value) if key in _OPS_NUMERIC else value)
+            for key, value in ops_prefs.items()
+            if key in _OPS_NUMERIC or key in _OPS_PASSTHROUGH})
 
 
 def expand_tags(tags):
     # We get the Tags as a list of key, value pairs, but CloudFormation needs
     # them exploded out to Key: key, Value: value.
-    tags_array = []
-    for tag in tags:
-        logger.debug(tag)
-        key, value = list(tag.items())[0]
-        tags_array.append({'Key': key, 'Value': value})
-    return(tags_array)
+    return([{'Key': key, 'Value': value}
+            for key, value in (next(iter(tag.items())) for tag in tags)])
 
 
 def expand_parameters(params):
     # We get the Parameters as a list of key, value pairs, but CloudFormation
     # needs them exploded out to ParameterKey: key, ParameterValue: value.
-    params_array = []
-    for param in params:
-        logger.debug(param)
-        key, value = list(param.items())[0]
-        params_array.append({'ParameterKey': key, 'ParameterValue': value})
-    return(params_array)
+    return([{'ParameterKey': key, 'ParameterValue': value}
+            for key, value in (next(iter(param.items())) for param in params)])
 
 
 def flatten_stacks(stackinstances):
     # Stack instances are defined across accounts and regions + parameter
     # overrides.  We want to expand all combinations before we take action.
+    # Keys are (account, region) tuples.
     flat_stacks = {}
     for instance in stackinstances:
-        for account in instance['Accounts']:
-            for region in instance['Regions']:
-                tuple = ("%s/%s" % (account, region))
-                if tuple in flat_stacks:
-                    raise Exception("%s / %s is defined multiple times" % (account, region))
-                if 'ParameterOverrides' in instance:
-                    flat_stacks[tuple] = instance['ParameterOverrides']
-                else:
-                    flat_stacks[tuple] = []
+        overrides = instance.get('ParameterOverrides', [])
+        for key in itertools.product(instance['Accounts'], instance['Regions']):
+            # A key we've already seen won't grow the dict
+            size = len(flat_stacks)
+            flat_stacks[key] = overrides
+            if len(flat_stacks) == size:
+                raise Exception("%s / %s is defined multiple times" % key)
     return(flat_stacks)
 
 
@@ -117,170 +145,203 @@ def group_by_account(set, flat_stacks):
     # Group regions by account and overrides
     grouped_accounts = {}
     for instance in set:
-        account, region = instance.split('/')
-        if account in grouped_accounts:
-            if flat_stacks[instance] == grouped_accounts[account]['overrides']:
-                grouped_accounts[account]['regions'].append(region)
-            else:
-                raise Exception("The overrides didn't match account group for %s" % instance)
-        else:
-            grouped_accounts[account] = {'regions': [region],
-                                         'overrides': flat_stacks[instance]}
+        account, region = instance
+        overrides = flat_stacks[instance]
+        group = grouped_accounts.setdefault(account, {'regions': [],
+                                                      'overrides': overrides})
+        if group['overrides'] != overrides:
+            raise Exception("The overrides didn't match account group for %s/%s" % instance)
+        group['regions'].append(region)
     return(grouped_accounts)
 
 
-def aggregate_instances(account_list, flat_stacks):
+def _freeze(overrides):
+    # Hashable, order-insensitive form of a ParameterOverrides list so it can
+    # be used as part of a dict key.
+    return tuple(sorted((key, repr(value))
+                        for override in overrides
+                        for key, value in override.items()))
+
+
+def bucket_by_overrides(account_list, flat_stacks):
     # First group regions by account and overrides
     accounts = group_by_account(account_list, flat_stacks)
 
-    # Aggregate accounts into instances with similar regions to reduce number
-    # of API calls
-    instances = []
-    while accounts.keys():
-        instance = {}
-        aggregated_accounts = []
-        (source_account, values) = accounts.popitem()
-        for account in accounts:
-            if accounts[account] == values:
-                aggregated_accounts.append(account)
-        for account in aggregated_accounts:
-            accounts.pop(account)
-        aggregated_accounts.append(source_account)
-        instance = {'accounts': aggregated_accounts,
-                    'regions': values['regions'],
-                    'overrides': values['overrides']}
-        instances.append(instance)
-    logger.debug(instances)
-    return(instances)
+    # Bucket accounts that share the same overrides and the same set of
+    # regions, so each bucket can go to CloudFormation as a single
+    # accounts x regions call.  Region order doesn't matter to the API, so
+    # the bucket key uses the sorted regions.
+    buckets = {}
+    for account, values in accounts.items():
+        regions = tuple(sorted(values['regions']))
+        key = (regions, _freeze(values['overrides']))
+        if key not in buckets:
+            buckets[key] = {'accounts': [],
+                            'regions': list(regions),
+                            'overrides': values['overrides']}
+        buckets[key]['accounts'].append(account)
+    buckets = list(buckets.values())
+    logger.debug(buckets)
+    return(buckets)
+
+
+def _cfn(region):
+    # Return the CloudFormation client for region, creating it on first use.
+    client = _client_cache.get(region)
+    if client is None:
+        client = boto3.client('cloudformation', region_name=region,
+                              config=_BOTO_CFG)
+        _client_cache[region] = client
+    return client
+
+
+def _wait_for_operation(region, set_name, op_id, polls=20, max_delay=15):
+    # Poll a StackSet operation until it reaches a terminal status.  Returns
+    # False if it didn't finish in time or can't be described.
+    client = _cfn(region)
+    for attempt in range(polls):
+        try:
+            response = client.describe_stack_set_operation(
+                StackSetName=set_name,
+                OperationId=op_id
+            )
+        except ClientError as e:
+            logger.warning("Unable to describe operation %s on %s: %s", op_id, set_name, e)
+            return False
+        status = response['StackSetOperation']['Status']
+        if status in _TERMINAL_OPERATION_STATUSES:
+            logger.info("Operation %s on %s finished with status %s", op_id, set_name, status)
+            return True
+        delay = min(2 ** attempt, max_delay)
+        logger.info("Operation %s on %s is %s. Checking again in %i seconds.", op_id, set_name, status, delay)
+        sleep(delay)
+    return False
+
+
+def _retry(op, op_name, set_name, region, retries=20, base=1.0,
+           max_delay=30):
+    # Call op() until it succeeds, waiting while another operation is in
+    # progress on the StackSet.  If we know the last operation we started on
+    # the set, poll it until it finishes and retry straight away; otherwise
+    # back off exponentially with full jitter.  Any other error, or the final
+    # OperationInProgressException, is left to the caller.
+    key = (set_name.split(':')[0], region)
+    for attempt in range(retries):
+        try:
+            response = op()
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'OperationInProgressException':
+                raise
+            if attempt == retries - 1:
+                raise
+            prev_op = _last_operation.pop(key, None)
+            if prev_op and _wait_for_operation(region, set_name, prev_op):
+                continue
+            delay = random.uniform(0, min(max_delay, base * 2 ** attempt))
+            logger.warning("Operation in progress for %s (%s). Sleeping for %.1f seconds.", set_name, op_name, delay)
+            sleep(delay)
+            continue
+        if isinstance(response, dict) and 'OperationId' in response:
+            _last_operation[key] = response['OperationId']
+        return response
+
+
+def _operation_id(op_name, params):
+    # Derive an OperationId (or ClientRequestToken) from the current request
+    # and the call's parameters.  If CloudFormation re-sends the same event,
+    # the same id is generated and CloudFormation rejects the duplicate
+    # instead of starting a second operation.  Accounts and regions are
+    # sorted as their order can vary between containers.
+    key = [request_id, op_name]
+    for name in sorted(params):
+        value = params[name]
+        if name in ('Accounts', 'Regions'):
+            value = sorted(value)
+        key.append((name, value))
+    return(hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:32])
+
+
+def _call_stack_instances(op_name, region, retries=20, **kwargs):
+    # Shared wrapper for the create/update/delete_stack_instances calls.
+    # kwargs are passed straight through to the boto3 method.
+    set_name = kwargs['StackSetName']
+    kwargs['OperationId'] = _operation_id(op_name, kwargs)
+    logger.info("Calling %s with op prefs %s", op_name, kwargs.get('OperationPreferences'))
+    logger.debug("%s: %s", op_name, kwargs)
+
+    method = getattr(_cfn(region), op_name)
+    try:
+        return(_retry(lambda: method(**kwargs), op_name, set_name, region,
+                      retries=retries))
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'OperationInProgressException':
+            raise Exception("Failed to %s after %s tries" % (op_name, retries))
+        elif e.response['Error']['Code'] == 'OperationIdAlreadyExistsException':
+            logger.warning("%s was already submitted as operation %s", op_name, kwargs['OperationId'])
+            return({'OperationId': kwargs['OperationId']})
+        elif e.response['Error']['Code'] == 'StackSetNotFoundException':
+            raise Exception("No StackSet matching %s found in %s. You must create before launching stacks." % (set_name, region))
+        else:
+            raise Exception("Unexpected error in %s: %s" % (op_name, e))
 
 
 def launch_stacks(set_region, set_name, accts, regions, param_overrides,
                   ops_prefs):
     # Wrapper for create_stack_instances
-    sleep_time = 15
-    retries = 20
-    this_try = 0
-
-    logger.info("Creating stacks with op prefs %s" % ops_prefs)
-    logger.debug("StackSetName: %s, Accounts: %s, Regions: %s, ParameterOverrides: %s" % (set_name, accts, regions, param_overrides))
-
-    while True:
-        try:
-            client = boto3.client('cloudformation', region_name=set_region)
-            response = client.create_stack_instances(
-                StackSetName=set_name,
-                Accounts=accts,
-                Regions=regions,
-                ParameterOverrides=param_overrides,
-                OperationPreferences=ops_prefs,
-                # OperationId='string'
-            )
-            return(response)
-        except ClientError as e:
-            if e.response['Error']['Code'] == 'OperationInProgressException':
-                this_try += 1
-                if this_try == retries:
-                    return("Failed to launch stacks after %s tries" % this_try)
-                else:
-                    logger.warning("Operation in progress for %s in %s. Sleeping for %i seconds." % (set_name, set_region, sleep_time))
-                    sleep(sleep_time)
-                    continue
-            elif e.response['Error']['Code'] == 'StackSetNotFoundException':
-                raise Exception("No StackSet matching %s found in %s. You must create before launching stacks." % (set_name, set_region))
-            else:
-                raise Exception("Error launching stack instance: %s" % e)
+    return(_call_stack_instances(
+        'create_stack_instances', set_region,
+        StackSetName=set_name,
+        Accounts=accts,
+        Regions=regions,
+        ParameterOverrides=param_overrides,
+        OperationPreferences=ops_prefs,
+    ))
 
 
 def update_stacks(set_region, set_name, accts, regions, param_overrides,
                   ops_prefs):
     # Wrapper for update_stack_instances
-    sleep_time = 15
-    retries = 20
-    this_try = 0
-
-    logger.info("Updating stacks with op prefs %s" % ops_prefs)
 
     # UpdateStackInstance only allows stackSetName, not stackSetId,
     # so we need to truncate.
     (set_name, uid) = set_name.split(':')
-    logger.debug("StackSetName: %s, Accounts: %s, Regions: %s, ParameterOverrides: %s" % (set_name, accts, regions, param_overrides))
-
-    while True:
-        try:
-            client = boto3.client('cloudformation', region_name=set_region)
-            response = client.update_stack_instances(
-                StackSetName=set_name,
-                Accounts=accts,
-                Regions=regions,
-                ParameterOverrides=param_overrides,
-                OperationPreferences=ops_prefs,
-                # OperationId='string'
-            )
-            return(response)
-        except ClientError as e:
-            if e.response['Error']['Code'] == 'OperationInProgressException':
-                this_try += 1
-                if this_try == retries:
-                    return("Failed to update stacks after %s tries" % this_try)
-                else:
-                    logger.warning("Operation in progress for %s in %s. Sleeping for %i seconds." % (set_name, set_region, sleep_time))
-                    sleep(sleep_time)
-                    continue
-            elif e.response['Error']['Code'] == 'StackSetNotFoundException':
-                raise Exception("No StackSet matching %s found in %s. You must create before launching stacks." % (set_name, set_region))
-            else:
-                raise Exception("Unexpected error: %s" % e)
+    return(_call_stack_instances(
+        'update_stack_instances', set_region,
+        StackSetName=set_name,
+        Accounts=accts,
+        Regions=regions,
+        ParameterOverrides=param_overrides,
+        OperationPreferences=ops_prefs,
+    ))
 
 
 def delete_stacks(set_region, set_id, accts, regions, ops_prefs):
-    # Wrapper for delete_stack_instances
-    sleep_time = 15
-    retries = 20
-    this_try = 0
-
-    logger.info("Deleting stacks with op prefs %s" % ops_prefs)
-    logger.debug("StackSetName: %s, Accounts: %s, Regions: %s" % (set_id, accts, regions))
-
-    while True:
-        try:
-            client = boto3.client('cloudformation', region_name=set_region)
-            response = client.delete_stack_instances(
-                StackSetName=set_id,
-                Accounts=accts,
-                Regions=regions,
-                OperationPreferences=ops_prefs,
-                RetainStacks=False,
-                # OperationId='string'
-            )
-            return(response)
-        except ClientError as e:
-            if e.response['Error']['Code'] == 'OperationInProgressException':
-                this_try += 1
-                if this_try == retries:
-                    return("Failed to delete stacks after %s tries" % this_try)
-                else:
-                    logger.warning("Operation in progress for %s in %s. Sleeping for %i seconds." % (set_id, set_region, sleep_time))
-                    sleep(sleep_time)
-                    continue
-            elif e.response['Error']['Code'] == 'StackSetNotFoundException':
-                return("No StackSet matching %s found in %s. You must create before launching stacks." % (set_id, set_region))
-            else:
-                return("Unexpected error: %s" % e)
+    # Wrapper for delete_stack_instances.  Errors are returned rather than
+    # raised so that delete() still goes on to remove the StackSet.
+    try:
+        return(_call_stack_instances(
+            'delete_stack_instances', set_region,
+            StackSetName=set_id,
+            Accounts=accts,
+            Regions=regions,
+            OperationPreferences=ops_prefs,
+            RetainStacks=False,
+        ))
+    except Exception as e:
+        return(str(e))
 
 
 def update_stack_set(set_region, set_id, set_description, set_template,
                      set_parameters, set_capabilities, set_tags, ops_prefs):
     # Set up for retries
-    sleep_time = 15
     retries = 20
-    this_try = 0
 
-    client = boto3.client('cloudformation', region_name=set_region)
+    client = _cfn(set_region)
+    op_id = _operation_id('update_stack_set', {'StackSetName': set_id})
 
-    # Retry loop
-    while True:
-        try:
-            response = client.update_stack_set(
+    try:
+        response = _retry(
+            lambda: client.update_stack_set(
                 StackSetName=set_id,
                 Description=set_description,
                 TemplateURL=set_template,
@@ -289,26 +350,24 @@ def update_stack_set(set_region, set_id, set_description, set_template,
                 Parameters=set_parameters,
                 Capabilities=set_capabilities,
                 Tags=set_tags,
-                OperationPreferences=ops_prefs
-                # OperationId='string'
-            )
-            if response['ResponseMetadata']['HTTPStatusCode'] == 200:
-                return set_id
-            else:
-                raise Exception("HTTP Error: %s" % response)
-        except ClientError as e:
-            if e.response['Error']['Code'] == 'OperationInProgressException':
-                this_try += 1
-                if this_try == retries:
-                    raise Exception("Failed to delete StackSet after %s tries." % this_try)
-                else:
-                    logger.warning("Operation in progress for %s. Sleeping for %i seconds." % (set_id, sleep_time))
-                    sleep(sleep_time)
-                    continue
-            elif e.response['Error']['Code'] == 'StackSetNotEmptyException':
-                raise Exception("There are still stacks in set %s. You must delete these first." % (set_id))
-            else:
-                raise Exception("Unexpected error: %s" % e)
+                OperationPreferences=ops_prefs,
+                OperationId=op_id
+            ),
+            'update_stack_set', set_id, set_region, retries=retries)
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'OperationInProgressException':
+            raise Exception("Failed to update StackSet after %s tries." % retries)
+        elif e.response['Error']['Code'] == 'OperationIdAlreadyExistsException':
+            logger.warning("StackSet update was already submitted as operation %s", op_id)
+            return set_id
+        elif e.response['Error']['Code'] == 'StackSetNotEmptyException':
+            raise Exception("There are still stacks in set %s. You must delete these first." % (set_id))
+        else:
+            raise Exception("Unexpected error: %s" % e)
+    if response['ResponseMetadata']['HTTPStatusCode'] == 200:
+        return set_id
+    else:
+        raise Exception("HTTP Error: %s" % response)
 
 
 def create(event, context):
@@ -366,8 +425,7 @@ def create(event, context):
 
     # Create the StackSet
     try:
-        client = boto3.client('cloudformation',
-                              region_name=os.environ['AWS_REGION'])
+        client = _cfn(_AWS_REGION)
         response = client.create_stack_set(
             StackSetName=set_name,
             Description=set_description,
@@ -377,8 +435,9 @@ def create(event, context):
             Capabilities=set_capabilities,
             Tags=set_tags,
             AdministrationRoleARN=set_admin_role_arn,
-            ExecutionRoleName=set_exec_role_name
-            # ClientRequestToken='string'
+            ExecutionRoleName=set_exec_role_name,
+            ClientRequestToken=_operation_id('create_stack_set',
+                                             {'StackSetName': set_name})
         )
         if response['ResponseMetadata']['HTTPStatusCode'] == 200:
             set_id = response['StackSetId']
@@ -389,7 +448,7 @@ def create(event, context):
             raise Exception("A StackSet called %s already exists." % set_name)
         else:
             raise Exception("Unexpected error: %s" % e)
-    logger.info("Created StackSet: %s" % set_id)
+    logger.info("Created StackSet: %s", set_id)
     physical_resource_id = set_id
 
     # Deploy stack to accounts and regions if defined.
@@ -403,7 +462,7 @@ def create(event, context):
             param_overrides = expand_parameters(instance['ParameterOverrides'])
         else:
             param_overrides = []
-        logger.debug("Stack Instance: Regions: %s : Accounts: %s : Parameters: %s" % (instance['Regions'], instance['Accounts'], param_overrides))
+        logger.debug("Stack Instance: Regions: %s : Accounts: %s : Parameters: %s", instance['Regions'], instance['Accounts'], param_overrides)
 
         # Make sure every stack instance defines both a list of accounts and
         # a list of regions
@@ -412,9 +471,9 @@ def create(event, context):
         elif instance['Regions'][0] == '' and instance['Accounts'][0] != '':
             raise Exception("You must specify at least one region with a list of accounts.")
         elif instance['Regions'][0] != '' and instance['Accounts'][0] != '':
-            logger.info("Launching stacks in accounts: %s and regions: %s" % (instance['Accounts'], instance['Regions']))
+            logger.info("Launching stacks in accounts: %s and regions: %s", instance['Accounts'], instance['Regions'])
             response = launch_stacks(
-                    os.environ['AWS_REGION'],
+                    _AWS_REGION,
                     set_id,
                     instance['Accounts'],
                     instance['Regions'],
@@ -441,17 +500,10 @@ def update(event, context):
         set_opsprefs = convert_ops_prefs(event['ResourceProperties']['OperationPreferences'])
     else:
         set_opsprefs = {}
-    logger.debug("OperationPreferences: %s" % set_opsprefs)
+    logger.debug("OperationPreferences: %s", set_opsprefs)
 
     # Circumstances under which we update the StackSet itself
-    stack_set_attributes = [
-        'TemplateURL',
-        'Parameters',
-        'Tags',
-        'Capabilities',
-        'StackSetDecription'
-    ]
-    stack_set_needs_update = change_requires_update(stack_set_attributes,
+    stack_set_needs_update = change_requires_update(_STACK_SET_UPDATE_ATTRS,
                                                     event['OldResourceProperties'],
                                                     event['ResourceProperties'])
 
@@ -466,7 +518,7 @@ def update(event, context):
             set_description = event['OldResourceProperties']['StackSetDescription']
         else:
             set_description = "This StackSet belongs to the CloudFormation stack %s." % get_stack_from_arn(event['StackId'])
-        logger.debug("StackSetDescription: %s" % set_description)
+        logger.debug("StackSetDescription: %s", set_description)
 
         if 'Capabilities' in event['ResourceProperties']:
             set_capabilities = event['ResourceProperties']['Capabilities']
@@ -474,7 +526,7 @@ def update(event, context):
             set_capabilities = event['OldResourceProperties']['Capabilities']
         else:
             set_capabilities = []
-        logger.debug("Capabilities: %s" % set_capabilities)
+        logger.debug("Capabilities: %s", set_capabilities)
 
         if 'Tags' in event['ResourceProperties']:
             set_tags = expand_tags(event['ResourceProperties']['Tags'])
@@ -482,7 +534,7 @@ def update(event, context):
             set_tags = expand_tags(event['OldResourceProperties']['Tags'])
         else:
             set_tags = []
-        logger.debug("Tags: %s" % set_tags)
+        logger.debug("Tags: %s", set_tags)
 
         if 'Parameters' in event['ResourceProperties']:
             set_parameters = expand_parameters(event['ResourceProperties']['Parameters'])
@@ -490,7 +542,7 @@ def update(event, context):
             set_parameters = expand_parameters(event['OldResourceProperties']['Parameters'])
         else:
             set_parameters = []
-        logger.debug("Parameters: %s" % set_parameters)
+        logger.debug("Parameters: %s", set_parameters)
 
         # Required properties
         logger.info("Evaluating required properties")
@@ -500,11 +552,11 @@ def update(event, context):
             set_template = event['OldResourceProperties']['TemplateURL']
         else:
             raise Exception('Template URL not found during update event')
-        logger.debug("TemplateURL: %s" % set_template)
+        logger.debug("TemplateURL: %s", set_template)
 
         # Update the StackSet
-        logger.info("Updating StackSet resource %s" % set_id)
-        update_stack_set(os.environ['AWS_REGION'], set_id, set_description,
+        logger.info("Updating StackSet resource %s", set_id)
+        update_stack_set(_AWS_REGION, set_id, set_description,
                          set_template, set_parameters, set_capabilities,
                          set_tags, set_opsprefs)
 
@@ -515,35 +567,45 @@ def update(event, context):
     if 'StackInstances' in event['ResourceProperties']:
         new_stacks = flatten_stacks(event['ResourceProperties']['StackInstances'])
     else:
-        new_stacks = []
+        new_stacks = {}
 
     if 'StackInstances' in event['OldResourceProperties']:
         old_stacks = flatten_stacks(event['OldResourceProperties']['StackInstances'])
     else:
-        old_stacks = []
+        old_stacks = {}
+
+    # Nothing to do for stack instances if the flattened definitions match
+    if new_stacks == old_stacks:
+        logger.info("No changes to stack instances")
+        physical_resource_id = set_id
+        response_data = {}
+        return physical_resource_id, response_data
 
     # Evaluate all differences we need to handle
-    to_add = list(set(new_stacks) - set(old_stacks))
-    to_delete = list(set(old_stacks) - set(new_stacks))
-    to_compare = list(set(old_stacks).intersection(new_stacks))
+    new_keys = frozenset(new_stacks)
+    old_keys = frozenset(old_stacks)
+    to_add = new_keys - old_keys
+    to_delete = old_keys - new_keys
+    to_compare = new_keys & old_keys
 
     # Launch all new stack instances
     if to_add:
-        logger.info("Adding stack instances:  %s" % to_add)
+        logger.info("Adding stack instances:  %s", to_add)
 
-        # Aggregate accounts with similar regions to reduce number of API calls
-        add_instances = aggregate_instances(to_add, new_stacks)
+        # Bucket accounts with matching regions and overrides to reduce
+        # number of API calls
+        add_instances = bucket_by_overrides(to_add, new_stacks)
 
         # Add stack instances
         for instance in add_instances:
-            logger.debug("Add aggregated accounts: %s and regions: %s and overrides: %s" % (instance['accounts'], instance['regions'], instance['overrides']))
+            logger.debug("Add bucketed accounts: %s and regions: %s and overrides: %s", instance['accounts'], instance['regions'], instance['overrides'])
             if 'overrides' in instance:
                 param_overrides = expand_parameters(instance['overrides'])
             else:
                 param_overrides = []
 
             response = launch_stacks(
-                    os.environ['AWS_REGION'],
+                    _AWS_REGION,
                     set_id,
                     instance['accounts'],
                     instance['regions'],
@@ -554,16 +616,17 @@ def update(event, context):
 
     # Delete all old stack instances
     if to_delete:
-        logger.info("Deleting stack instances: %s" % to_delete)
+        logger.info("Deleting stack instances: %s", to_delete)
 
-        # Aggregate accounts with similar regions to reduce number of API calls
-        delete_instances = aggregate_instances(to_delete, old_stacks)
+        # Bucket accounts with matching regions and overrides to reduce
+        # number of API calls
+        delete_instances = bucket_by_overrides(to_delete, old_stacks)
 
-        # Add stack instances
+        # Delete stack instances
         for instance in delete_instances:
-            logger.debug("Delete aggregated accounts: %s and regions: %s" % (instance['accounts'], instance['regions']))
+            logger.debug("Delete bucketed accounts: %s and regions: %s", instance['accounts'], instance['regions'])
             response = delete_stacks(
-                    os.environ['AWS_REGION'],
+                    _AWS_REGION,
                     set_id,
                     instance['accounts'],
                     instance['regions'],
@@ -573,35 +636,34 @@ def update(event, context):
 
     # Determine if any existing instances need to be updated
     if to_compare:
-        logger.info("Examining stack instances: %s" % to_compare)
+        logger.info("Examining stack instances: %s", to_compare)
 
         # Update any stacks in both lists, but with new overrides
-        to_update = []
-        for instance in to_compare:
-            if old_stacks[instance] == new_stacks[instance]:
-                logger.debug("%s: SAME!" % instance)
-            else:
-                logger.debug("%s: DIFFERENT!" % instance)
-                to_update.append(instance)
-
-        # Aggregate accounts with similar regions to reduce number of API calls
-        update_instances = aggregate_instances(to_update, new_stacks)
-        for instance in update_instances:
-            logger.debug("Update aggregated accounts: %s and regions: %s with overrides %s" % (instance['accounts'], instance['regions'], instance['overrides']))
-            if 'overrides' in instance:
-                param_overrides = expand_parameters(instance['overrides'])
-            else:
-                param_overrides = []
-
-            response = update_stacks(
-                    os.environ['AWS_REGION'],
-                    set_id,
-                    instance['accounts'],
-                    instance['regions'],
-                    param_overrides,
-                    set_opsprefs
-            )
-            logger.debug(response)
+        to_update = [instance for instance in to_compare
+                     if old_stacks[instance] != new_stacks[instance]]
+        logger.debug("Stack instances with changed overrides: %s", to_update)
+
+        if to_update:
+            # Bucket accounts with matching regions and overrides to reduce
+            # number of API calls
+            update_instances = bucket_by_overrides(to_update, new_stacks)
+
+            for instance in update_instances:
+                logger.debug("Update bucketed accounts: %s and regions: %s with overrides %s", instance['accounts'], instance['regions'], instance['overrides'])
+                if 'overrides' in instance:
+                    param_overrides = expand_parameters(instance['overrides'])
+                else:
+                    param_overrides = []
+
+                response = update_stacks(
+                        _AWS_REGION,
+                        set_id,
+                        instance['accounts'],
+                        instance['regions'],
+                        param_overrides,
+                        set_opsprefs
+                )
+                logger.debug(response)
 
     physical_resource_id = set_id
     response_data = {}
@@ -615,9 +677,7 @@ def delete(event, context):
     Delete StackSet resource and any stack instances specified in the template.
     """
     # Set up for retries
-    sleep_time = 15
     retries = 20
-    this_try = 0
 
     # Collect everything we need to delete the stack set
     set_id = event['PhysicalResourceId']
@@ -635,48 +695,49 @@ def delete(event, context):
         else:
             set_opsprefs = {}
 
-        # Iterate over stack instances
-        for instance in event['ResourceProperties']['StackInstances']:
-            logger.debug("Stack Instance: Regions: %s : Accounts: %s" % (instance['Regions'], instance['Accounts']))
+        # Overrides don't matter when deleting, so drop them and bucket
+        # purely on regions.  Skip the empty placeholders create() ignores.
+        # create() accepts blocks that overlap, so don't use flatten_stacks
+        # here: it would reject the duplicates and leave the stack stuck.
+        keys = {key for instance in event['ResourceProperties']['StackInstances']
+                for key in itertools.product(instance['Accounts'], instance['Regions'])
+                if '' not in key}
+        flat_stacks = dict.fromkeys(keys, [])
+        delete_instances = bucket_by_overrides(list(flat_stacks), flat_stacks)
 
-            logger.info("Removing existing stacks from stack set %s" % set_id)
+        logger.info("Removing existing stacks from stack set %s", set_id)
 
+        for instance in delete_instances:
+            logger.debug("Delete bucketed accounts: %s and regions: %s", instance['accounts'], instance['regions'])
             response = delete_stacks(
-                os.environ['AWS_REGION'],
+                _AWS_REGION,
                 set_id,
-                instance['Accounts'],
-                instance['Regions'],
+                instance['accounts'],
+                instance['regions'],
                 set_opsprefs
             )
             logger.debug(response)
 
-    client = boto3.client('cloudformation',
-                          region_name=os.environ['AWS_REGION'])
+    client = _cfn(_AWS_REGION)
 
-    # Retry loop
     logger.info('Deleting stack set')
-    while True:
-        try:
-            response = client.delete_stack_set(
+    try:
+        response = _retry(
+            lambda: client.delete_stack_set(
                 StackSetName=set_id
-            )
-            if response['ResponseMetadata']['HTTPStatusCode'] == 200:
-                return
-            else:
-                raise Exception("HTTP Error: %s" % response)
-        except ClientError as e:
-            if e.response['Error']['Code'] == 'OperationInProgressException':
-                this_try += 1
-                if this_try == retries:
-                    raise Exception("Failed to delete StackSet after %s tries." % this_try)
-                else:
-                    logger.warning("Operation in progress for %s. Sleeping for %i seconds." % (set_id, sleep_time))
-                    sleep(sleep_time)
-                    continue
-            elif e.response['Error']['Code'] == 'StackSetNotEmptyException':
-                raise Exception("There are still stacks in set %s. You must delete these first." % (set_id))
-            else:
-                raise Exception("Unexpected error: %s" % e)
+            ),
+            'delete_stack_set', set_id, _AWS_REGION, retries=retries)
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'OperationInProgressException':
+            raise Exception("Failed to delete StackSet after %s tries." % retries)
+        elif e.response['Error']['Code'] == 'StackSetNotEmptyException':
+            raise Exception("There are still stacks in set %s. You must delete these first." % (set_id))
+        else:
+            raise Exception("Unexpected error: %s" % e)
+    if response['ResponseMetadata']['HTTPStatusCode'] == 200:
+        return
+    else:
+        raise Exception("HTTP Error: %s" % response)
 
 
 def handler(event, context):
@@ -684,7 +745,8 @@ def handler(event, context):
     Main handler function, passes off it's work to crhelper's cfn_handler
     """
     # update the logger with event info
-    global logger
+    global logger, request_id
     logger = crhelper.log_config(event)
+    request_id = event['RequestId']
     return crhelper.cfn_handler(event, context, create, update, delete, logger,
                                 init_failed)